@@ -287,7 +287,7 @@ def get_config(handler=None):
 
 def load_component(page, **kwargs):
     '''return generateed template'''
-    return gramex.cache.open(page, 'template', rel=True).generate(**kwargs)
+    return gramex.cache.open(os.path.join(FOLDER, page), 'template').generate(**kwargs)
 
 
 def load_layout(config):
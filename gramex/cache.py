@@ -7,23 +7,40 @@ import sys
 import json
 import time
 import atexit
-import inspect
+import hashlib
+import locale
+import pickle         # nosec - only used to hash data, not to load it
 import requests
 import tempfile
 import mimetypes
 import subprocess       # nosec
 import pandas as pd
 import tornado.template
-from threading import Thread
-from six.moves.queue import Queue
+from threading import Thread, Lock
+from operator import itemgetter
+from types import FunctionType, CodeType
+from six.moves.queue import Queue, Full
 from orderedattrdict import AttrDict
 from tornado.concurrent import Future
 from tornado.ioloop import IOLoop, PeriodicCallback
 from gramex.config import app_log, merge, used_kwargs, CustomJSONDecoder, CustomJSONEncoder
 from six.moves.urllib_parse import urlparse
+try:
+    from xxhash import xxh3_64 as _hasher
+except ImportError:
+    _hasher = lambda: hashlib.blake2b(digest_size=8)    # noqa: E731
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from cachetools import Cache, LRUCache
+except ImportError:
+    Cache, LRUCache = dict, None
 
 
 MILLISECOND = 0.001         # in seconds
+_EXIT_POLL_MAX = 0.1        # Subprocess checks if the process exited at least this often
 _opener_defaults = dict(mode='r', buffering=-1, encoding='utf-8', errors='strict',
                         newline=None, closefd=True)
 _markdown_defaults = dict(output_format='html5', extensions=[
@@ -56,6 +73,49 @@ def hashfn(fn):
     return id(fn)
 
 
+def _shared_hashfn(fn):
+    '''
+    Returns a hash value for the function that is the same across processes.
+    Used when the cache is shared between processes (e.g. disk or redis caches.)
+    id(fn) differs across processes, and may match a different function elsewhere.
+    '''
+    if fn is None:
+        return None
+    name = getattr(fn, '__qualname__', '<')
+    # Lambdas, nested functions, methods and callable objects can't be identified by name.
+    # Use the process ID to ensure that they don't clash with other processes
+    if not isinstance(fn, FunctionType) or '<' in name:
+        return (os.getpid(), hashfn(fn))
+    # Functions with the same name (e.g. all YAML transforms are "transform") may differ in
+    # their code, constants, names, defaults or closures (e.g. decorated functions). Hash all
+    # of these. This also ensures that reloaded modules don't re-use stale data
+    cells = tuple(cell.cell_contents for cell in fn.__closure__ or ())
+    cells = tuple(_shared_hashfn(cell) if callable(cell) else cell for cell in cells)
+    state = repr((fn.__defaults__, fn.__kwdefaults__, cells))
+    # Values like <object at 0x...> are process-specific
+    if ' at 0x' in state:
+        return (os.getpid(), hashfn(fn))
+    digest = _hasher()
+    _hash_code(digest, fn.__code__)
+    digest.update(state.encode('utf-8'))
+    return (fn.__module__, name, digest.hexdigest())
+
+
+def _hash_code(digest, code):
+    '''Update digest with the bytecode, constants and names of a code object, recursively'''
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _hash_code(digest, const)
+        else:
+            # frozenset order varies with PYTHONHASHSEED. Sort it to get the same repr
+            if isinstance(const, frozenset):
+                const = sorted(repr(v) for v in const)
+            digest.update(repr(const).encode('utf-8'))
+        digest.update(b'\0')
+
+
 def cache_key(*args):
     '''Converts arguments into a string suitable for use as a cache key'''
     return json.dumps(args, sort_keys=True, separators=(',', ':'))
@@ -89,36 +149,99 @@ def opener(callback, read=False, **open_kwargs):
     When reading binary files, pass ``mode='rb', encoding=None, errors=None``.
     '''
     merge(open_kwargs, _opener_defaults, 'setdefault')
-    if read:
+    if not read and not callable(callback):
+        raise ValueError('opener callback %s not a function', repr(callback))
+    # Generate a method(path, mode=..., encoding=..., **kwargs) whose keyword
+    # arguments default to open_kwargs. Python separates the io.open arguments
+    # from the callback's kwargs when calling it, avoiding dict operations per call
+    args = ''.join('{0}=_defaults[{0!r}], '.format(key) for key in open_kwargs)
+    open_args = ', '.join('{0}={0}'.format(key) for key in open_kwargs)
+    if not read:
+        # Pass handle to callback
+        body = '\twith io.open(path, %s) as handle:\n\t\treturn callback(handle, **kwargs)'
+    elif callable(callback):
         # Pass contents to callback
-        def method(path, **kwargs):
-            open_args = {key: kwargs.pop(key, val) for key, val in open_kwargs.items()}
-            with io.open(path, **open_args) as handle:
-                result = handle.read()
-                return callback(result, **kwargs) if callable(callback) else result
+        body = '\treturn callback(_read(path, %s), **kwargs)'
     else:
-        if not callable(callback):
-            raise ValueError('opener callback %s not a function', repr(callback))
-
-        # Pass handle to callback
-        def method(path, **kwargs):
-            open_args = {key: kwargs.pop(key, val) for key, val in open_kwargs.items()}
-            with io.open(path, **open_args) as handle:
-                return callback(handle, **kwargs)
-    return method
+        body = '\treturn _read(path, %s)'
+    code = compile(''.join(['def method(path, ', args, '**kwargs):\n', body % open_args]),
+                   filename='opener:%s' % getattr(callback, '__name__', callback), mode='exec')
+    context = {'io': io, '_read': _read, '_defaults': open_kwargs, 'callback': callback}
+    exec(code, context)         # nosec - code only has io.open argument names
+    return context['method']
 
 
-@opener
-def _markdown(handle, **kwargs):
+def _read(path, mode='r', encoding=None, errors=None, newline=None, **open_args):
+    '''
+    Returns the contents of path, like io.open(path, ...).read(). But text files
+    are read as bytes and decoded in one go, which is faster than text mode's
+    incremental decoder. Universal newlines are translated if newline is None.
+    '''
+    if 'b' in mode:
+        with io.open(path, mode=mode, encoding=encoding, errors=errors, newline=newline,
+                     **open_args) as handle:
+            return handle.read()
+    with io.open(path, mode=mode.replace('t', '') + 'b', **open_args) as handle:
+        result = handle.read()
+    result = result.decode(encoding or locale.getpreferredencoding(False), errors or 'strict')
+    if newline is None:
+        result = result.replace('\r\n', '\n').replace('\r', '\n')
+    return result
+
+
+def _markdown_load(text, output_format=_markdown_defaults['output_format'],
+                   extensions=_markdown_defaults['extensions'], **kwargs):
     from markdown import markdown
-    return markdown(handle.read(), **{k: kwargs.pop(k, v) for k, v in _markdown_defaults.items()})
+    return markdown(text, output_format=output_format, extensions=extensions)
 
 
-@opener
-def _yaml(handle, **kwargs):
+def _yaml_load(text, Loader=None, **kwargs):
     import yaml
-    defaults = {'Loader': yaml.FullLoader}
-    return yaml.load(handle.read(), **{k: kwargs.pop(k, v) for k, v in defaults.items()})
+    # Use the libyaml C loader if PyYAML is compiled with it. It's ~10x faster
+    if Loader is None:
+        Loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+    return yaml.load(text, Loader=Loader)
+
+
+def _json_loads(text, **kwargs):
+    # orjson is faster, but does not support kwargs like object_pairs_hook=, nor NaN, etc.
+    if orjson is not None and not kwargs:
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            pass
+    return json.loads(text, **kwargs)
+
+
+_markdown = opener(_markdown_load, read=True)
+_yaml = opener(_yaml_load, read=True)
+_json = opener(_json_loads, read=True)
+
+
+# Pandas' own engines. gramex.cache.open() does not retry if these fail
+_DEFAULT_ENGINES = {None, 'c', 'python'}
+
+
+def _engine_fallback(method):
+    '''
+    Wraps a Pandas reader like pd.read_csv. If the ``engine=`` passed (e.g.
+    ``pyarrow``, ``calamine``) is not installed, or does not support the other
+    arguments, log a warning and read using the default Pandas engine. Parse
+    errors, and errors from the default engines, are raised as-is.
+    '''
+    def reader(path, **kwargs):
+        if kwargs.get('engine') in _DEFAULT_ENGINES:
+            return method(path, **kwargs)
+        try:
+            return method(path, **kwargs)
+        except (ImportError, ValueError) as e:
+            if isinstance(e, pd.errors.ParserError):
+                raise
+            engine = kwargs.pop('engine')
+            app_log.warning('gramex.cache.open: %s(engine=%r) failed: %s. Using default engine',
+                            method.__name__, engine, e)
+            return method(path, **kwargs)
+    return reader
 
 
 def _template(path, **kwargs):
@@ -126,14 +249,176 @@ def _template(path, **kwargs):
     return tornado.template.Loader(root, **kwargs).load(name)
 
 
-def stat(path):
+# gramex.cache.stat(hash=True) stores content fingerprints here. {path: (mtime, size, hash)}
+_FINGERPRINT_CACHE = {}
+# gramex.cache.stat(ttl=...) stores recent results here. {path: (monotonic_time, (mtime, size))}
+_STAT_CACHE = {}
+# Default ttl for gramex.cache.open(). 0 checks the file on every call
+_STAT_TTL = 0
+# gramex.cache.watch_stat() stores file stats here until watchdog reports a change.
+# {path: (abspath, (mtime, size))}
+_WATCHED_STATS = {}
+# {folder: watchdog ObservedWatch for the folder (not sub-folders), or None if not watchable}
+_WATCHED_FOLDERS = {}
+# observer is the watchdog observer, if enabled. generation changes on every event
+_WATCH_STATE = {'observer': None, 'generation': 0}
+# _WATCH_LOCK guards _WATCHED_STATS. _WATCH_FOLDER_LOCK guards _WATCHED_FOLDERS and the
+# observer. Watchdog holds its own lock when it sends events. So event handlers only use
+# _WATCH_LOCK, and we never (un)schedule watches while holding _WATCH_LOCK
+_WATCH_LOCK = Lock()
+_WATCH_FOLDER_LOCK = Lock()
+
+
+def _fingerprint(path):
+    '''Returns a hex digest of the file contents. Uses xxhash if installed, else blake2b'''
+    hasher = _hasher()
+    with io.open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(io.DEFAULT_BUFFER_SIZE * 16), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (None, None)
+    return (stat.st_mtime, stat.st_size)
+
+
+def stat(path, hash=False, ttl=0):
     '''
-    Returns a file status tuple - based on file last modified time and file size
+    Returns a file status tuple - based on file last modified time and file size.
+
+    If ``hash=True``, returns a ``(mtime, size, fingerprint)`` tuple, where
+    fingerprint is a hash of the file contents. The contents are re-hashed only
+    if the mtime or size changed since the last call.
+
+    If ``ttl`` is positive, the file is checked at most once every ``ttl``
+    seconds. Calls in between return the last status.
+
+    If :py:func:`watch_stat` is enabled, ``ttl`` is ignored. The status is
+    remembered until watchdog reports a change to the file.
     '''
-    if os.path.exists(path):
-        stat = os.stat(path)
-        return (stat.st_mtime, stat.st_size)
-    return (None, None)
+    if _WATCH_STATE['observer'] is not None:
+        result = _watched_stat(path)
+    elif ttl > 0:
+        now = time.monotonic()
+        cached = _STAT_CACHE.get(path)
+        if cached is not None and now - cached[0] < ttl:
+            result = cached[1]
+        else:
+            result = _stat(path)
+            _STAT_CACHE[path] = (now, result)
+    else:
+        result = _stat(path)
+    if hash:
+        if result[0] is None:
+            return (None, None, None)
+        cached = _FINGERPRINT_CACHE.get(path)
+        if cached is None or cached[:2] != result:
+            cached = _FINGERPRINT_CACHE[path] = result + (_fingerprint(path), )
+        return cached
+    return result
+
+
+def watch_stat(enable=True):
+    '''
+    If enabled, :py:func:`stat` (and hence :py:func:`open`) remembers file
+    stats until `watchdog <https://pythonhosted.org/watchdog/>`_ reports a
+    change to the file, instead of calling ``os.stat()`` every time. Only the
+    folders of opened files are watched, not their sub-folders. Files in folders
+    that cannot be watched are checked on every call. ``watch_stat(False)``
+    removes all watches.
+
+    Watchdog may not see changes on network file systems (e.g. NFS) made by other
+    machines. Don't enable this on such folders.
+
+    Returns True if enabled, False if disabled or watchdog is not installed.
+    '''
+    with _WATCH_FOLDER_LOCK:
+        observer, _WATCH_STATE['observer'] = _WATCH_STATE['observer'], None
+        for watch in _WATCHED_FOLDERS.values():
+            if watch is not None:
+                observer.unschedule(watch)
+        _WATCHED_FOLDERS.clear()
+    with _WATCH_LOCK:
+        # Bump the generation so that stats being computed now are not stored
+        _WATCH_STATE['generation'] += 1
+        _WATCHED_STATS.clear()
+    if not enable:
+        return False
+    try:
+        from gramex.services.watcher import observer
+    except ImportError:
+        app_log.warning('gramex.cache.watch_stat: watchdog not installed. Checking every call')
+        return False
+    with _WATCH_FOLDER_LOCK:
+        _WATCH_STATE['observer'] = observer
+    return True
+
+
+class _StatEventHandler(object):
+    '''A watchdog event handler that forgets the stats of changed files'''
+    def dispatch(self, event):
+        _on_file_event(event)
+
+
+def _watch_folder(folder):
+    '''Watch folder (but not its sub-folders) for changes. Return the watch, or None'''
+    with _WATCH_FOLDER_LOCK:
+        observer = _WATCH_STATE['observer']
+        if observer is None:
+            return None
+        if folder not in _WATCHED_FOLDERS:
+            try:
+                watch = observer.schedule(_StatEventHandler(), folder, recursive=False)
+            except Exception as e:
+                # The folder may be missing, unreadable, or the OS may be out of watches
+                app_log.debug('gramex.cache.watch_stat: cannot watch %s: %s', folder, e)
+                watch = None
+            _WATCHED_FOLDERS[folder] = watch
+        return _WATCHED_FOLDERS[folder]
+
+
+def _watched_stat(path):
+    cached = _WATCHED_STATS.get(path)
+    if cached is not None:
+        return cached[1]
+    # If a file changes (or watch_stat is disabled) while we stat it, don't store the result
+    generation = _WATCH_STATE['generation']
+    abspath = os.path.abspath(path)
+    folder = os.path.dirname(abspath)
+    watch = _WATCHED_FOLDERS.get(folder, False)
+    if watch is False:
+        watch = _watch_folder(folder)
+    result = _stat(path)
+    if watch is not None:
+        with _WATCH_LOCK:
+            if generation == _WATCH_STATE['generation']:
+                _WATCHED_STATS[path] = (abspath, result)
+    return result
+
+
+def _on_file_event(event):
+    '''Forget stats of files (or files under folders) that watchdog reports as changed'''
+    # Reading a file (e.g. via open()) does not change its stat
+    if event.event_type in {'opened', 'closed_no_write'}:
+        return
+    paths = [os.path.abspath(event.src_path)]
+    if getattr(event, 'dest_path', None):
+        paths.append(os.path.abspath(event.dest_path))
+    # A folder is "modified" when a file in it is added or removed. That file gets its own
+    # event. Only forget all stats under a folder if the folder is deleted or moved
+    if event.is_directory and event.event_type not in {'deleted', 'moved'}:
+        prefixes = ()
+    else:
+        prefixes = tuple(path + os.sep for path in paths)
+    with _WATCH_LOCK:
+        _WATCH_STATE['generation'] += 1
+        for key, (abspath, result) in list(_WATCHED_STATS.items()):
+            if abspath in paths or abspath.startswith(prefixes):
+                del _WATCHED_STATS[key]
 
 
 def hashed(val):
@@ -148,24 +433,46 @@ def hashed(val):
             return None
 
 
+def sizeof(obj):
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (set, list, tuple)):
+        return sys.getsizeof(obj) + sum(sizeof(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+# gramex.cache.open() and gramex.cache.query() hold up to this many bytes by default
+_CACHE_BYTES = int(os.environ.get('GRAMEX_CACHE_BYTES', 500000000))
+
+
+def _bounded_cache():
+    '''Returns an LRU cache that holds up to _CACHE_BYTES. Without cachetools, a dict'''
+    return {} if LRUCache is None else LRUCache(_CACHE_BYTES, getsizeof=sizeof)
+
+
+# gramex.cache.open(rel=True) caches the caller's folder here. {caller_filename: folder}
+_FOLDER_CACHE = {}
 # gramex.cache.open() stores its cache here.
-# {(path, callback): {data: ..., stat: ...}}
-_OPEN_CACHE = {}
+# {(path, callback, transform, kwargs): (data, stat)}
+_OPEN_CACHE = _bounded_cache()
+_NO_KWARGS = frozenset()
+# Caches that live in this process. Other caches (disk, redis) may be shared across processes
+_LOCAL_CACHES = (dict, Cache)
 _OPEN_CALLBACKS = dict(
     bin=opener(None, read=True, mode='rb', encoding=None, errors=None),
     txt=opener(None, read=True),
     text=opener(None, read=True),
-    csv=pd.read_csv,
-    excel=pd.read_excel,
-    xls=pd.read_excel,
-    xlsx=pd.read_excel,
+    csv=_engine_fallback(pd.read_csv),
+    excel=_engine_fallback(pd.read_excel),
+    xls=_engine_fallback(pd.read_excel),
+    xlsx=_engine_fallback(pd.read_excel),
     hdf=pd.read_hdf,
     h5=pd.read_hdf,
     html=pd.read_html,
     jsondata=pd.read_json,
     sas=pd.read_sas,
     stata=pd.read_stata,
-    table=pd.read_table,
+    table=_engine_fallback(pd.read_table),
     parquet=pd.read_parquet,
     feather=pd.read_feather,
     md=_markdown,
@@ -173,11 +480,12 @@ _OPEN_CALLBACKS = dict(
     tmpl=_template,
     template=_template,
     yml=_yaml,
-    yaml=_yaml
+    yaml=_yaml,
+    json=_json,
 )
 
 
-def open(path, callback=None, transform=None, rel=False, **kwargs):
+def open(path, callback=None, transform=None, rel=False, hash=False, jit=False, **kwargs):
     '''
     Reads a file, processes it via a callback, caches the result and returns it.
     When called again, returns the cached result unless the file has updated.
@@ -191,10 +499,10 @@ def open(path, callback=None, transform=None, rel=False, **kwargs):
 
     - ``bin``: reads binary files using io.open
     - ``text`` or ``txt``: reads text files using io.open
-    - ``yaml``: reads files using yaml.load via io.open
+    - ``yaml``: reads files using yaml.load via io.open (using libyaml if available)
     - ``config``: reads files using using :py:class:`gramex.config.PathConfig`.
       Same as ``yaml``, but allows ``import:`` and variable substitution.
-    - ``json``: reads files using json.load via io.open
+    - ``json``: reads files using json.load via io.open (using orjson if available)
     - ``jsondata``: reads files using pd.read_json
     - ``template``: reads files using tornado.Template via io.open
     - ``markdown`` or ``md``: reads files using markdown.markdown via io.open
@@ -213,6 +521,13 @@ def open(path, callback=None, transform=None, rel=False, **kwargs):
         # Load data.csv as CSV into a Pandas DataFrame
         open('data.csv', 'csv', encoding='cp1252')
 
+        # Load data.csv using the faster multi-threaded PyArrow parser
+        open('data.csv', 'csv', engine='pyarrow')
+
+    For ``csv``, ``table`` and Excel files, if the ``engine=`` (e.g. ``pyarrow``
+    or ``calamine``) is not installed or does not support the other arguments,
+    the default Pandas engine is used.
+
     It can also be a function that accepts the filename and any other arguments::
 
         # Load data using a custom callback
@@ -232,39 +547,65 @@ def open(path, callback=None, transform=None, rel=False, **kwargs):
 
     If ``transform=`` is not a callable, it is ignored, but used as a cache key.
 
+    ``jit=True`` compiles the transform using `numba <https://numba.pydata.org/>`_
+    the first time and re-uses the compiled code. This speeds up numeric
+    transforms on NumPy arrays. If numba is not installed, or cannot compile the
+    transform, the transform runs as-is.
+
     ``rel=True`` opens the path relative to the caller function's file path. If
     ``D:/app/calc.py`` calls ``open('data.csv', 'csv', rel=True)``, the path
-    is replaced with ``D:/app/data.csv``.
+    is replaced with ``D:/app/data.csv``. This inspects the caller's frame on
+    every call. In frequently called code, use :py:func:`relative_to` instead.
+
+    ``hash=True`` reloads the file only if its contents change, not just its
+    modified time. This avoids reloads when files are touched or replaced with
+    identical content, at the cost of hashing the file when its mtime changes.
 
     Any other keyword arguments are passed directly to the callback. If the
     callback is a predefined string and uses io.open, all argument applicable to
     io.open are passed to io.open and the rest are passed to the callback.
+
+    Results are cached in memory, evicting the least recently used results when
+    they exceed the ``GRAMEX_CACHE_BYTES`` environment variable (default: 500MB).
     '''
     # Pass _reload_status = True for testing purposes. This returns a tuple:
     # (result, reloaded) instead of just the result.
     _reload_status = kwargs.pop('_reload_status', False)
     reloaded = False
     _cache = kwargs.pop('_cache', _OPEN_CACHE)
+    # Pass _stat_ttl = <seconds> to check the file at most once every few seconds
+    _stat_ttl = kwargs.pop('_stat_ttl', _STAT_TTL)
 
     # Get the parent frame's filename. Compute path relative to that.
     if rel:
-        stack = inspect.getouterframes(inspect.currentframe(), 2)
-        folder = os.path.dirname(os.path.abspath(stack[1][1]))
+        filename = sys._getframe(1).f_code.co_filename
+        folder = _FOLDER_CACHE.get(filename)
+        if folder is None:
+            folder = _FOLDER_CACHE[filename] = os.path.dirname(os.path.abspath(filename))
         path = os.path.join(folder, path)
 
     original_callback = callback
     if callback is None:
         callback = os.path.splitext(path)[-1][1:]
     callback_is_str = isinstance(callback, six.string_types)
+    # Caches outside this process (disk, redis) need keys that are the same in every process
+    if isinstance(_cache, _LOCAL_CACHES):
+        fnkey, transform_key = id, hashfn(transform)
+        kwargs_key = frozenset((k, hashed(v)) for k, v in kwargs.items())
+    else:
+        fnkey, transform_key = _shared_hashfn, _shared_hashfn(transform)
+        # frozenset order (and its pickle) varies with PYTHONHASHSEED. Use a sorted tuple
+        kwargs_key = tuple(sorted(((k, hashed(v)) for k, v in kwargs.items()), key=itemgetter(0)))
     key = (
         path,
-        original_callback if callback_is_str else id(callback),
-        hashfn(transform),
-        frozenset(((k, hashed(v)) for k, v in kwargs.items())),
+        original_callback if callback_is_str else fnkey(callback),
+        transform_key,
+        kwargs_key if kwargs else _NO_KWARGS,
     )
     cached = _cache.get(key, None)
-    fstat = stat(path)
-    if cached is None or fstat != cached.get('stat'):
+    # With hash=True, compare only the content fingerprint, ignoring mtime and size
+    fstat = stat(path, hash=True, ttl=_stat_ttl)[2] if hash else stat(path, ttl=_stat_ttl)
+    if cached is None or fstat != cached[1]:
         reloaded = True
         if callable(callback):
             data = callback(path, **kwargs)
@@ -272,9 +613,6 @@ def open(path, callback=None, transform=None, rel=False, **kwargs):
             method = None
             if callback in _OPEN_CALLBACKS:
                 method = _OPEN_CALLBACKS[callback]
-            elif callback in {'json'}:
-                import json
-                method = opener(json.load)
             elif callback in {'config'}:
                 from gramex.config import PathConfig
                 method = PathConfig
@@ -291,16 +629,71 @@ def open(path, callback=None, transform=None, rel=False, **kwargs):
         else:
             raise TypeError('gramex.cache.open(callback=) must be a function, not %r' % callback)
         if callable(transform):
-            data = transform(data)
-        cached = {'data': data, 'stat': fstat}
+            data = _jit_transform(transform, data) if jit else transform(data)
+        cached = (data, fstat)
         try:
             _cache[key] = cached
+        except ValueError:
+            # cachetools.LRUCache raises a ValueError if the data is too large to cache
+            app_log.warning('gramex.cache.open: %s is too large to cache', path)
         except Exception:
             app_log.error('gramex.cache.open: %s cannot cache %r' % (type(_cache), data))
-    result = cached['data']
+    result = cached[0]
     return (result, reloaded) if _reload_status else result
 
 
+def relative_to(file):
+    '''
+    Returns a function like :py:func:`open` that opens paths relative to the
+    folder of ``file``. This is a faster alternative to ``open(..., rel=True)``
+    since it does not inspect the caller's frame. For example::
+
+        _open = gramex.cache.relative_to(__file__)
+        data = _open('data.csv', 'csv')     # Opens data.csv in this file's folder
+    '''
+    folder = os.path.dirname(os.path.abspath(file))
+
+    def _open(path, *args, **kwargs):
+        return open(os.path.join(folder, path), *args, **kwargs)
+
+    return _open
+
+
+# gramex.cache.open(jit=True) caches compiled transforms here. {hashfn(transform): compiled}
+_JIT_CACHE = {}
+
+
+def _jit_transform(transform, data):
+    '''
+    Run transform(data) via a numba-compiled transform. If numba is not installed
+    or cannot compile the transform for this data, run the transform as-is.
+    Compiled (or failed) transforms are cached and reused.
+    '''
+    key = hashfn(transform)
+    compiled = _JIT_CACHE.get(key, None)
+    if compiled is None:
+        try:
+            import numba
+        except ImportError:
+            app_log.warning('gramex.cache.open(jit=True) requires numba. Ignoring jit')
+            compiled = transform
+        else:
+            # numba rejects builtins, etc. with a TypeError
+            try:
+                compiled = numba.njit(transform)
+            except TypeError:
+                compiled = transform
+        _JIT_CACHE[key] = compiled
+    if compiled is not transform:
+        try:
+            return compiled(data)
+        # numba raises a TypingError (or other errors) for non-numeric transforms
+        except Exception as e:
+            app_log.debug('gramex.cache.open: cannot jit %r: %s', transform, e)
+            _JIT_CACHE[key] = transform
+    return transform(data)
+
+
 def set_cache(cache, old_cache):
     '''
     Use ``cache`` as the new cache for all open requests.
@@ -345,26 +738,27 @@ def save(data, url, callback=None, **kwargs):
 
 
 # gramex.cache.query() stores its cache here
-_QUERY_CACHE = {}
+_QUERY_CACHE = _bounded_cache()
 _STATUS_METHODS = {}
 
 
 def _wheres(dbkey, tablekey, default_db, names, fn=None):
     '''
     Convert a table name list like ['sales', 'dept.sales']) to a WHERE clause
-    like ``(table="sales") OR (db="dept" AND table="sales")``.
-
-    TODO: escape the table names to avoid SQL injection attacks
+    like ``(table=:table0) OR (db=:db1 AND table=:table1)`` and a dict of bound
+    parameters like ``{'db0': default_db, 'table0': 'sales', 'db1': 'dept', ...}``.
+    Since table names are bound parameters, they are escaped by the database driver.
     '''
-    where = []
-    for name in names:
+    where, params = [], {}
+    for index, name in enumerate(names):
         db, table = name.rsplit('.', 2) if '.' in name else (default_db, name)
+        params['db%d' % index], params['table%d' % index] = db, table
         if not fn:
-            where.append("({}='{}' AND {}='{}')".format(dbkey, db, tablekey, table))
+            where.append('({}=:db{} AND {}=:table{})'.format(dbkey, index, tablekey, index))
         else:
-            where.append("({}={}('{}') AND {}={}('{}'))".format(
-                dbkey, fn[0], db, tablekey, fn[1], table))
-    return ' OR '.join(where)
+            where.append('({}={}(:db{}) AND {}={}(:table{}))'.format(
+                dbkey, fn[0], index, tablekey, fn[1], index))
+    return ' OR '.join(where), params
 
 
 def _table_status(engine, tables):
@@ -385,16 +779,17 @@ def _table_status(engine, tables):
         if dialect == 'mysql':
             # https://dev.mysql.com/doc/refman/5.7/en/tables-table.html
             # Works only on MySQL 5.7 and above
-            q = ('SELECT update_time FROM information_schema.tables WHERE ' +
-                 _wheres('table_schema', 'table_name', db, tables))
+            where, params = _wheres('table_schema', 'table_name', db, tables)
+            q = 'SELECT update_time FROM information_schema.tables WHERE ' + where
         elif dialect == 'mssql':
             # https://goo.gl/b4aL9m
-            q = ('SELECT last_user_update FROM sys.dm_db_index_usage_stats WHERE ' +
-                 _wheres('database_id', 'object_id', db, tables, fn=['DB_ID', 'OBJECT_ID']))
+            where, params = _wheres('database_id', 'object_id', db, tables,
+                                    fn=['DB_ID', 'OBJECT_ID'])
+            q = 'SELECT last_user_update FROM sys.dm_db_index_usage_stats WHERE ' + where
         elif dialect == 'postgresql':
             # https://www.postgresql.org/docs/9.6/static/monitoring-stats.html
-            q = ('SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_all_tables WHERE ' +
-                 _wheres('schemaname', 'relname', 'public', tables))
+            where, params = _wheres('schemaname', 'relname', 'public', tables)
+            q = 'SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_all_tables WHERE ' + where
         elif dialect == 'sqlite':
             if not db:
                 raise KeyError('gramex.cache.query does not support memory sqlite "%s"' % dialect)
@@ -404,10 +799,34 @@ def _table_status(engine, tables):
         if dialect == 'sqlite':
             _STATUS_METHODS[key] = lambda: stat(q)
         else:
-            _STATUS_METHODS[key] = lambda: pd.read_sql(q, engine).to_json(orient='records')
+            # Compile the query once, with table names as bound parameters
+            from sqlalchemy import text
+            stmt = text(q).bindparams(**params)
+            _STATUS_METHODS[key] = lambda: _fetch_rows(engine, stmt)
     return _STATUS_METHODS[key]()
 
 
+def _fetch_rows(engine, stmt):
+    '''Returns the result of a (small) SQL query as a tuple of row tuples'''
+    with engine.connect() as conn:
+        return tuple(tuple(row) for row in conn.execute(stmt))
+
+
+def _frame_digest(data):
+    '''
+    Returns a fixed-size hash of a DataFrame's columns and values. Comparing
+    this is faster than comparing (and storing) the whole DataFrame.
+    '''
+    digest = _hasher()
+    digest.update(repr(list(data.columns)).encode('utf-8'))
+    try:
+        digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    except TypeError:
+        # Object columns with unhashable values (e.g. lists, dicts from ARRAY / JSON columns)
+        digest.update(pickle.dumps(data.to_dict(orient='list')))
+    return digest.hexdigest()
+
+
 def query(sql, engine, state=None, **kwargs):
     '''
     Read SQL query or database table into a DataFrame. Caches results unless
@@ -421,6 +840,8 @@ def query(sql, engine, state=None, **kwargs):
     3. A list of tables. This list of ["db.table"] names specifies which tables
        to watch for. This is currently experimental.
     4. ``None``: the default. The query is always re-run and not cached.
+
+    Like :py:func:`open`, results are cached in memory up to ``GRAMEX_CACHE_BYTES``.
     '''
     # Pass _reload_status = True for testing purposes. This returns a tuple:
     # (result, reloaded) instead of just the result.
@@ -435,7 +856,7 @@ def query(sql, engine, state=None, **kwargs):
     if isinstance(state, (list, tuple)):
         status = _table_status(engine, tuple(state))
     elif isinstance(state, six.string_types):
-        status = pd.read_sql(state, engine).to_dict(orient='list')
+        status = _frame_digest(pd.read_sql(state, engine))
     elif callable(state):
         status = state()
     elif state is None:
@@ -453,10 +874,14 @@ def query(sql, engine, state=None, **kwargs):
                       state, kwargs)
         result = pd.read_sql(sql, engine, **kwargs)
         if store_cache:
-            _cache[key] = {
-                'data': result,
-                'status': status,
-            }
+            try:
+                _cache[key] = {
+                    'data': result,
+                    'status': status,
+                }
+            except ValueError:
+                # cachetools.LRUCache raises a ValueError if the result is too large to cache
+                app_log.warning('gramex.cache.query: result too large to cache: %s', sql)
         reloaded = True
 
     return (result, reloaded) if _reload_status else result
@@ -486,18 +911,13 @@ def reload_module(*modules):
         # sys.__file__ does not exist, but don't raise a warning. You can't reload it
         if name in {'sys'}:
             continue
-        if name is None or path is None or not os.path.exists(path):
+        # On Python 3, __file__ points to the .py file. So just stat() it once
+        # https://www.python.org/dev/peps/pep-3147/#file
+        fstat = _stat(path) if path is not None else (None, None)
+        if name is None or fstat[0] is None:
             app_log.warning('Path for module %s is %s: not found', name, path)
             continue
-        # On Python 3, __file__ points to the .py file. In Python 2, it's the .pyc file
-        # https://www.python.org/dev/peps/pep-3147/#file
-        if path.lower().endswith('.pyc'):
-            path = path[:-1]
-            if not os.path.exists(path):
-                app_log.warning('Path for module %s is %s: not found', name, path)
-                continue
         # The first time, don't reload it. Thereafter, if it's older or resized, reload it
-        fstat = stat(path)
         if fstat != _MODULE_CACHE.get(name, fstat):
             app_log.info('Reloading module %s', name)
             six.moves.reload_module(module)
@@ -547,7 +967,8 @@ class Subprocess(object):
     https://github.com/tornadoweb/tornado/issues/1585
 
     This is a threaded alternative based on
-    http://stackoverflow.com/a/4896288/100904
+    http://stackoverflow.com/a/4896288/100904. But on POSIX, if an IOLoop is
+    running, it reads the process output from the IOLoop without threads.
 
     Run a program async and wait for it to execute. Then get its output::
 
@@ -614,6 +1035,8 @@ class Subprocess(object):
     - OR a list of any of the above
     - OR an empty list. In this case, ``.wait_for_exit()`` returns a tuple with
       ``stdout`` and ``stderr`` as a tuple of byte strings.
+
+    If an IOLoop is running, callbacks run on the IOLoop. They must not block.
     '''
 
     def __init__(self, args, stream_stdout=[], stream_stderr=[], buffer_size=0, **kwargs):
@@ -631,48 +1054,32 @@ class Subprocess(object):
         self.thread = {}        # Has the running threads
         self.future = {}        # Stores the futures indicating stream close
         self.loop = _get_current_ioloop()
+        # On POSIX, if an IOLoop is running, read the pipes from the IOLoop.
+        # Else (e.g. on Windows, where IOLoop can't watch pipes) read them via threads
+        use_ioloop = os.name == 'posix' and _is_running(self.loop)
 
         # Buffering has 2 modes. buffer_size='line' reads and writes line by line
-        # buffer_size=<number> reads in byte chunks. Define the appropriate method
+        # buffer_size=<number> reads in byte chunks. buffer_size=None indicates lines
         if hasattr(buffer_size, 'lower') and 'line' in buffer_size.lower():
-            def _write(stream, callbacks, future, retval):
-                '''Call callbacks with content from stream. On EOF mark future as done'''
-                while True:
-                    content = stream.readline()
-                    if len(content) > 0:
-                        if isinstance(content, six.text_type):
-                            content = content.encode('utf-8')
-                        for callback in callbacks:
-                            callback(content)
-                    else:
-                        stream.close()
-                        break
-                while self.proc.poll() is None:
-                    time.sleep(MILLISECOND)
-                self.loop.add_callback(future.set_result, retval())
-        else:
-            # If the buffer size is 0 or negative, use the default buffer size to read
-            if buffer_size <= 0:
-                buffer_size = io.DEFAULT_BUFFER_SIZE
-
-            def _write(stream, callbacks, future, retval):
-                '''Call callbacks with content from stream. On EOF mark future as done'''
-                while True:
-                    content = stream.read(buffer_size)
-                    size = len(content)
-                    if size > 0:
-                        if isinstance(content, six.text_type):
-                            content = content.encode('utf-8')
-                        for callback in callbacks:
-                            # This may raise a ValueError: write to closed file.
-                            # TODO: decide how to handle it.
-                            callback(content)
-                    if size < buffer_size:
-                        stream.close()
-                        break
-                while self.proc.poll() is None:
-                    time.sleep(MILLISECOND)
-                self.loop.add_callback(future.set_result, retval())
+            buffer_size = None
+        # If the buffer size is 0 or negative, use the default buffer size to read
+        elif buffer_size <= 0:
+            buffer_size = io.DEFAULT_BUFFER_SIZE
+        read_size = max(buffer_size or 0, io.DEFAULT_BUFFER_SIZE)
+
+        def _write(stream, callbacks, future, retval):
+            '''Call callbacks with content from stream. On EOF mark future as done'''
+            # os.read() on the file descriptor skips the Python buffered / text IO layers
+            fd, feed = stream.fileno(), _feeder(callbacks, buffer_size)
+            while True:
+                content = os.read(fd, read_size)
+                feed(content)
+                if not content:
+                    stream.close()
+                    break
+            while self.proc.poll() is None:
+                time.sleep(MILLISECOND)
+            self.loop.add_callback(future.set_result, retval())
 
         callbacks_lookup = {'stdout': stream_stdout, 'stderr': stream_stderr}
         for stream in ('stdout', 'stderr'):
@@ -707,6 +1114,10 @@ class Subprocess(object):
                     else:
                         raise ValueError('Invalid stream_%s: %s', stream, method)
             self.future[stream] = future = Future()
+            if use_ioloop:
+                self._add_reader(getattr(self.proc, stream), callbacks, future, retval,
+                                 buffer_size, read_size)
+                continue
             # Thread writes from self.proc.stdout / stderr to appropriate callbacks
             self.thread[stream] = t = Thread(
                 target=_write,
@@ -715,6 +1126,37 @@ class Subprocess(object):
             t.daemon = True     # Thread dies with the program
             t.start()
 
+    def _add_reader(self, stream, callbacks, future, retval, buffer_size, read_size):
+        '''
+        Call callbacks with content from stream when the IOLoop finds it readable.
+        On EOF mark future as done when the process exits.
+        '''
+        fd, feed = stream.fileno(), _feeder(callbacks, buffer_size)
+        os.set_blocking(fd, False)
+
+        def on_read(fd, events):
+            try:
+                content = os.read(fd, read_size)
+            except BlockingIOError:
+                return
+            try:
+                feed(content)
+            finally:
+                # At EOF, the fd stays readable. Always stop watching it, else the IOLoop spins
+                if not content:
+                    self.loop.remove_handler(fd)
+                    stream.close()
+                    on_exit()
+
+        def on_exit(delay=MILLISECOND):
+            # The process may close its output but keep running. Poll less often over time
+            if self.proc.poll() is None:
+                self.loop.call_later(delay, on_exit, min(delay * 2, _EXIT_POLL_MAX))
+            else:
+                future.set_result(retval())
+
+        self.loop.add_handler(fd, on_read, IOLoop.READ | IOLoop.ERROR)
+
     def wait_for_exit(self):
         '''
         Returns futures for (stdout, stderr). To wait for the process to complete, use::
@@ -724,6 +1166,42 @@ class Subprocess(object):
         return [self.future['stdout'], self.future['stderr']]
 
 
+def _feeder(callbacks, buffer_size):
+    '''
+    Returns a ``feed(content)`` function that buffers byte strings and calls
+    callbacks with complete lines (if buffer_size is None) or with chunks of
+    buffer_size bytes. ``feed(b'')`` marks the end, and sends what's left.
+    '''
+    pending = [b'']
+
+    def write(content):
+        for callback in list(callbacks):
+            # A failing callback (e.g. writing to a closed handler) must not stop reading
+            try:
+                callback(content)
+            except Exception:
+                app_log.exception('cache.Subprocess: %r failed. Not calling it again', callback)
+                callbacks.remove(callback)
+
+    def feed(content):
+        data, start = pending[0] + content, 0
+        if buffer_size is None:
+            end = data.find(b'\n') + 1
+            while end > 0:
+                write(data[start:end])
+                start, end = end, data.find(b'\n', end) + 1
+        else:
+            while len(data) - start >= buffer_size:
+                write(data[start:start + buffer_size])
+                start += buffer_size
+        pending[0] = data[start:]
+        if not content and pending[0]:
+            write(pending[0])
+            pending[0] = b''
+
+    return feed
+
+
 _daemons = {}
 _regex_type = type(re.compile(''))
 # Python 3 needs sys.stderr.buffer.write for writing binary strings
@@ -748,15 +1226,24 @@ def daemon(args, restart=1, first_line=None, stream=True, timeout=5, buffer_size
     except (TypeError, ValueError):
         app_log.error('daemon args must be JSON serializable')
         raise
-    # Send the stdout and stderr to (a) stderr AND to (b) a local queue we read
+    # Send the stdout and stderr to (a) stderr AND to (b) a local queue we read.
+    # We only read the first line from the queue. Drop later lines instead of blocking,
+    # since callbacks may run on the IOLoop
     queue = Queue(maxsize=10)
+
+    def enqueue(content):
+        try:
+            queue.put_nowait(content)
+        except Full:
+            pass
+
     for channel in ('stream_stdout', 'stream_stderr'):
         if channel not in kwargs:
             kwargs[channel] = []
         elif not isinstance(kwargs[channel], list):
             kwargs[channel] = [kwargs[channel]]
         if first_line:
-            kwargs[channel].append(queue.put)
+            kwargs[channel].append(enqueue)
         if stream is True:
             kwargs[channel].append(_stderr_write)
         elif callable(stream):
@@ -815,6 +1302,12 @@ def daemon(args, restart=1, first_line=None, stream=True, timeout=5, buffer_size
     return future
 
 
+def _is_running(loop):
+    '''Returns True if loop is an IOLoop that is running'''
+    asyncio_loop = getattr(loop, 'asyncio_loop', None)
+    return asyncio_loop is not None and asyncio_loop.is_running()
+
+
 def _get_current_ioloop():
     '''
     Return the current IOLoop. But if we're not already in an IOLoop, return an
@@ -1214,11 +1707,3 @@ def _create_path(path):
     if not os.path.exists(folder):
         os.makedirs(folder)
     return path
-
-
-def sizeof(obj):
-    if isinstance(obj, dict):
-        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.items())
-    elif isinstance(obj, (set, list)):
-        return sys.getsizeof(obj) + sum(sizeof(v) for v in obj)
-    return sys.getsizeof(obj)
@@ -1,32 +1,27 @@
 import gramex.cache
-import jmespath
 import json
 import os
 import pytest
 import re
-import requests
 from fnmatch import fnmatch
+from functools import lru_cache
+from six.moves.http_cookiejar import DefaultCookiePolicy
 from gramex.config import ChainConfig, PathConfig, objectpath, variables, CustomJSONEncoder
-from lxml.html import document_fromstring
 from orderedattrdict import AttrDict
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions
-from selenium.webdriver.support.ui import WebDriverWait
 from six import string_types
 from time import sleep
 from tornado.web import create_signed_value
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Get Gramex conf from current directory
 gramex_conf = ChainConfig()
 gramex_conf['source'] = PathConfig(os.path.join(variables['GRAMEXPATH'], 'gramex.yaml'))
 gramex_conf['base'] = PathConfig('gramex.yaml')
 secret = objectpath(+gramex_conf, 'app.settings.cookie_secret')
-drivers = {}
 default = object()
-get_el = expected_conditions.presence_of_element_located
 context_global, context_local = {}, {}
 mode = AttrDict(debug=0, mark='', skip=False)
 MAX = 999999
@@ -63,10 +58,20 @@ def pytest_collect_file(parent, path):
         return YamlFile(path, parent)
 
 
-def pytest_runtest_teardown(item, nextitem):
-    if nextitem is None:
-        for browser, driver in drivers.items():
-            driver.quit()
+def pytest_collection_finish(session):
+    # parallel: true fetches only the urltest: items that will run (e.g. not deselected by -k)
+    for item in session.items:
+        parallel = getattr(item, 'parallel', None)
+        if parallel is not None:
+            batch, registry = parallel
+            batch.add(item, registry)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # Quit only the browsers that tests actually used, and close the shared HTTP session
+    drivers.release()
+    if URLTest.session is not None:
+        URLTest.session.close()
 
 
 class YamlFile(pytest.File):
@@ -75,8 +80,8 @@ class YamlFile(pytest.File):
     '''
     def _parse(self, index, actions):
         '''Return the test name as '''
-        if isinstance(actions, string_types):
-            actions = {actions: {}}
+        # gramex.cache.open() returns the same cached conf for an unchanged file. Don't modify it
+        actions = {actions: {}} if isinstance(actions, string_types) else dict(actions)
         # name: "#0xx: <first action of the test>"
         if 'name' in actions:
             name = actions.pop('name')
@@ -91,21 +96,36 @@ class YamlFile(pytest.File):
     def collect(self):
         # TODO: report error if YAML is invalid
         conf = gramex.cache.open(str(self.fspath), 'config')
-        # TODO: create browser only when running test
+        # Browsers are created when the first uitest: item for that browser runs
+        browsers = {}
         for browser, kwargs in conf.get('browsers', {}).items():
             if kwargs in (False, None):
                 continue
-            kwargs = kwargs if isinstance(kwargs, dict) else {}
-            capabilities = globals().get(browser + 'Conf')(**kwargs)
-            drivers[browser] = getattr(webdriver, browser)(desired_capabilities=capabilities)
+            browsers[browser] = kwargs if isinstance(kwargs, dict) else {}
+        # parallel: true (or number of threads) runs all urltest: fetches in parallel
+        parallel = conf.get('parallel', False)
+        batch = ParallelFetch(8 if parallel is True else parallel) if parallel else None
         # TODO: improve naming so that we can use pytest -k
         for index, actions in enumerate(conf.get('urltest', [])):
             name, actions = self._parse(index, actions)
-            yield YamlItem('url #{}'.format(name), self, actions, URLTest())
+            registry = URLTest()
+            item = YamlItem('url #{}'.format(name), self, actions, registry)
+            if batch is not None:
+                # pytest_collection_finish() adds the item to the batch if it will run
+                item.parallel = batch, registry
+            yield item
         for index, actions in enumerate(conf.get('uitest', [])):
             name, actions = self._parse(index, actions)
-            for browser in drivers:
-                yield YamlItem('{} #{}'.format(browser, name), self, actions, UITest(browser))
+            for browser, kwargs in browsers.items():
+                yield YamlItem('{} #{}'.format(browser, name), self, actions,
+                               UITest(browser, kwargs))
+
+
+@lru_cache(maxsize=1024)
+def _parse_action(action):
+    # "fetch url" -> ("fetch", ("url",)). Actions repeat across tests. So parse each once
+    parts = action.strip().split(None, 1)
+    return parts[0], tuple(parts[1:])
 
 
 class YamlItem(pytest.Item):
@@ -113,9 +133,8 @@ class YamlItem(pytest.Item):
         self.run = []
         self.name = name
         for action, options in actions.items():
-            # In PY3, this is simpler: cmd, *arg = action.strip().split(maxsplit=1)
-            parts = action.strip().split(None, 1)
-            cmd, arg = (parts[0], parts[1:]) if len(parts) > 1 else (parts[0], [])
+            cmd, arg = _parse_action(action)
+            arg = list(arg)
             method = getattr(registry, cmd, None)
             if method is None:
                 raise ConfError('ERROR: Unknown action: {}'.format(action))
@@ -169,10 +188,56 @@ class BaseTest(object):
             sleep(seconds)
 
 
+@lru_cache(maxsize=256)
+def _jmespath(path):
+    import jmespath
+    return jmespath.compile(path)
+
+
+@lru_cache(maxsize=256)
+def _css(selector):
+    # Same as lxml.html's tree.cssselect(selector), but compiles each selector once
+    from lxml.cssselect import CSSSelector
+    return CSSSelector(selector, translator='html')
+
+
+def _json_loads(response):
+    # orjson is faster than requests' .json(), but only parses UTF-8 and rejects NaN, etc.
+    if orjson is not None:
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            pass
+    return response.json()
+
+
+def _session():
+    '''
+    Returns a requests.Session that re-uses connections across fetches. Cookies are
+    not stored in the session. So each fetch: is independent, like requests.request()
+    '''
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 class URLTest(BaseTest):
     r = None
+    session = None
+    # html: parses the response once. _tree is the parsed _tree_response
+    _tree = _tree_response = None
+    # json: parses the response once. _json is the parsed _json_response
+    _json = _json_response = None
+
+    def fetch(self, *args, **kwargs):
+        URLTest.r = self._request(*args, **kwargs)
 
-    def fetch(self, url, method='GET', timeout=10, headers=None, user=None, **kwargs):
+    def _request(self, url, method='GET', timeout=10, headers=None, user=None, **kwargs):
         if user:
             if secret is None:
                 raise ConfError('Missing gramex.yaml:app.settings.cookie_secret. ' +
@@ -181,7 +246,9 @@ class URLTest(BaseTest):
             if headers is None:
                 headers = {}
             headers['X-Gramex-User'] = create_signed_value(secret, 'user', user)
-        URLTest.r = requests.request(method, url, timeout=timeout, headers=headers, **kwargs)
+        if URLTest.session is None:
+            URLTest.session = _session()
+        return self.session.request(method, url, timeout=timeout, headers=headers, **kwargs)
 
     def code(self, expected):
         match(self.r.status_code, expected, 'code')
@@ -195,20 +262,27 @@ class URLTest(BaseTest):
             match(result.get(header, None), expected, 'headers', header)
 
     def json(self, **paths):
-        try:
-            result = self.r.json()
-        except Exception as e:
-            raise ConfError('json: invalid. %s\n\n%s' % (e, self.r.text))
+        if URLTest._json_response is not self.r:
+            try:
+                URLTest._json = _json_loads(self.r)
+            except Exception as e:
+                raise ConfError('json: invalid. %s\n\n%s' % (e, self.r.text))
+            URLTest._json_response = self.r
+        result = URLTest._json
         for path, expected in paths.items():
-            match(jmespath.search(path, result), expected, 'json', path)
+            match(_jmespath(path).search(result), expected, 'json', path)
 
     def html(self, **matches):
-        try:
-            tree = document_fromstring(self.r.text)
-        except Exception as e:
-            raise ConfError('html: invalid. %s\n\n%s' % (e, self.r.text))
+        from lxml.html import document_fromstring
+        if URLTest._tree_response is not self.r:
+            try:
+                URLTest._tree = document_fromstring(self.r.text)
+            except Exception as e:
+                raise ConfError('html: invalid. %s\n\n%s' % (e, self.r.text))
+            URLTest._tree_response = self.r
+        tree = URLTest._tree
         for selector, value in matches.items():
-            nodes = tree.cssselect(selector)
+            nodes = _css(selector)(tree)
             if not isinstance(value, dict):
                 if len(nodes) == 0:
                     raise ConfError('html: %s matched no nodes' % selector)
@@ -226,10 +300,108 @@ class URLTest(BaseTest):
                             match(node.get(attr), val, 'html', selector, attr)
 
 
+class ParallelFetch(object):
+    '''
+    Runs the fetch: actions of many urltest: items in parallel. When the first item
+    runs, all fetches start in a thread pool. Each item then waits for its response.
+    The fetches must not depend on each other. E.g. don't GET a value that an
+    earlier test POSTs.
+
+    Only fetches before the first skip: action are run in parallel. Since skip:
+    may skip the tests after it, later fetches run only when their test runs.
+    '''
+    def __init__(self, workers):
+        self.workers = workers
+        self.calls = []
+        self.futures = None
+        self.skipped = False
+
+    def add(self, item, registry):
+        '''Replace the fetch: actions in item with a lookup of the parallel results'''
+        for step in item.run:
+            if step[0] == registry.skip:
+                self.skipped = True
+            if self.skipped:
+                return
+            if step[0] == registry.fetch:
+                self.calls.append((registry._request, step[1], step[2]))
+                step[:] = [self.fetch, [len(self.calls) - 1], {}]
+
+    def fetch(self, index):
+        if self.futures is None:
+            from concurrent.futures import ThreadPoolExecutor
+            # Create the shared session before threads use it
+            if URLTest.session is None:
+                URLTest.session = _session()
+            executor = ThreadPoolExecutor(self.workers)
+            self.futures = [executor.submit(method, *args, **kwargs)
+                            for method, args, kwargs in self.calls]
+            executor.shutdown(wait=False)
+        URLTest.r = self.futures[index].result()
+
+
+@lru_cache(maxsize=1)
+def _attrs_script():
+    # Returns JS that gets the attributes arguments[1] (via Selenium's getAttribute atom,
+    # like WebElement.get_attribute), properties arguments[2] and outerHTML of arguments[0]
+    import pkgutil
+    atom = pkgutil.get_data('selenium.webdriver.remote', 'getAttribute.js').decode('utf-8')
+    return (
+        'var get = (%s), node = arguments[0];'
+        'var result = {attrs: {}, props: {}, html: node.outerHTML};'
+        'arguments[1].forEach(function (name) { result.attrs[name] = get(node, name) });'
+        'arguments[2].forEach(function (name) { result.props[name] = node[name] });'
+        'return result;') % atom
+
+
+class DriverPool(dict):
+    '''
+    Shares one WebDriver per browser configuration across all uitest: items, in all
+    gramextest*.yaml files. ``acquire(browser, conf)`` returns the driver, creating it
+    on first use. ``release()`` quits all drivers.
+
+    If a browser's conf has ``remote: <url>``, it connects via ``webdriver.Remote`` to
+    a WebDriver server already running at that URL (e.g. Selenium Grid, or
+    ``chromedriver --port=9515``). The server stays up across test runs, so each run
+    skips the driver's startup.
+    '''
+    def acquire(self, browser, conf):
+        key = (browser, json.dumps(conf, sort_keys=True))
+        if key not in self:
+            # selenium is slow to import. Import it only if there are browsers to test
+            from selenium import webdriver
+            conf = dict(conf)
+            remote = conf.pop('remote', None)
+            capabilities = globals().get(browser + 'Conf')(**conf)
+            if remote:
+                driver = webdriver.Remote(command_executor=remote,
+                                          desired_capabilities=capabilities)
+            else:
+                driver = getattr(webdriver, browser)(desired_capabilities=capabilities)
+            self[key] = driver
+        return self[key]
+
+    def release(self):
+        for key, driver in self.items():
+            driver.quit()
+        self.clear()
+
+
+drivers = DriverPool()
+
+
 class UITest(BaseTest):
-    def __init__(self, browser):
+    def __init__(self, browser, conf):
         self.browser = browser
-        self.driver = drivers[browser]
+        self._conf = conf
+        self._driver = None
+
+    @property
+    def driver(self):
+        # Create the browser on first use, not during collection
+        if self._driver is None:
+            self._driver = drivers.acquire(self.browser, self._conf)
+        return self._driver
 
     def find(self, selector, _text=default, **attrs):
         msg = self.browser + ': find ' + selector
@@ -244,22 +416,32 @@ class UITest(BaseTest):
         elif node is None:
             # TODO: Fix all error reporting
             raise ConfError('%s matched no nodes' % selector)
+        if not attrs:
+            return
+        # Get all attributes, :properties and outerHTML in 1 WebDriver call, not 1 per key
+        names = [key for key in attrs if not key.startswith(('.', ':'))]
+        props = [key[1:] for key in attrs if key.startswith(':')]
+        values = self.driver.execute_script(_attrs_script(), node, names, props)
         for key, expected in attrs.items():
             if key == '.length':
                 actual = len(self._get(selector, multiple=True))
             elif key.startswith('.'):
                 actual = getattr(node, key[1:])
             elif key.startswith(':'):
-                actual = node.get_property(key[1:])
+                actual = values['props'].get(key[1:])
             else:
-                actual = node.get_attribute(key)
-            match(actual, expected, msg, key, node.get_attribute('outerHTML'))
+                actual = values['attrs'][key]
+            match(actual, expected, msg, key, values['html'])
 
     def print(self, selector):                      # noqa
         for node in self._get(selector, multiple=True, must_exist=True):
             print(node.get_attribute('outerHTML'))  # noqa
 
     def wait(self, seconds=default, **attrs):
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions
+        from selenium.webdriver.support.ui import WebDriverWait
         if seconds != default:
             sleep(seconds)
             return
@@ -269,7 +451,8 @@ class UITest(BaseTest):
             opt = selector.strip().split(None, 1)
             args = (By.XPATH, opt[1]) if opt[0] == 'xpath' else (By.CSS_SELECTOR, selector)
             try:
-                WebDriverWait(self.driver, timeout).until(get_el(args))
+                WebDriverWait(self.driver, timeout).until(
+                    expected_conditions.presence_of_element_located(args))
             except TimeoutException:
                 raise ConfError('selector: "%s" timed out after %.0fs' % (selector, timeout))
         if 'script' in attrs:
@@ -281,12 +464,14 @@ class UITest(BaseTest):
                 raise ConfError('script: "%s" timed out after %.0fs' % (script, timeout))
 
     def click(self, selector):
+        from selenium.common.exceptions import WebDriverException
         try:
             self._get(selector, must_exist=True).click()
         except WebDriverException as e:
             raise ConfError('Cannot click on %s: %s' % (selector, e))
 
     def hover(self, selector):
+        from selenium.webdriver.common.action_chains import ActionChains
         ActionChains(self.driver).move_to_element(self._get(selector)).perform()
 
     def title(self, text):
@@ -359,19 +544,23 @@ class UITest(BaseTest):
     def clear(self, selector):
         self._get(selector, must_exist=True).clear()
 
+    # (engine, multiple) -> (WebDriver method, By strategy). The strategies are the values of
+    # selenium's By.CSS_SELECTOR and By.XPATH, spelt out to avoid importing selenium here
     select_method = {
-        ('css', True): 'find_elements_by_css_selector',
-        ('css', False): 'find_element_by_css_selector',
-        ('xpath', True): 'find_elements_by_xpath',
-        ('xpath', False): 'find_element_by_xpath',
+        ('css', True): ('find_elements', 'css selector'),
+        ('css', False): ('find_element', 'css selector'),
+        ('xpath', True): ('find_elements', 'xpath'),
+        ('xpath', False): ('find_element', 'xpath'),
     }
 
     def _get(self, selector, multiple=False, must_exist=False):
+        from selenium.common.exceptions import NoSuchElementException
         engine = 'css'
         if selector.startswith('xpath '):
             engine, selector = selector.split(None, 1)
         try:
-            return getattr(self.driver, self.select_method[engine, multiple])(selector)
+            method, by = self.select_method[engine, multiple]
+            return getattr(self.driver, method)(by, selector)
         except NoSuchElementException:
             if must_exist:
                 raise ConfError('No element: ' + selector)
@@ -379,93 +568,148 @@ class UITest(BaseTest):
                 return None
 
 
-def add_operator(grouping, *args):
+def add_operator(grouping, *args, prepare=None):
+    # prepare(actual) transforms the actual value once before comparing with each expected value
+    # UPPERCASE names are case-sensitive operators. Others match in any case ("Starts With")
     method = args[-1]
     for name in args[:-1]:
-        operators[name] = (grouping, method)
-
-
-def eq(condition, msg):
-    if not condition:
-        raise ConfError(msg)
+        table = operators_cs if name.isupper() else operators_ci
+        table[name.lower() if table is operators_ci else name] = (grouping, method, prepare)
 
 
 def norm(s):
     return s.strip().lower()
 
 
-def match_operator(actual, expected, msg):
-    if expected[0] in operators:
-        grouping, method = operators[expected[0]]
-        eq(grouping(method(actual, value) for value in expected[1:]),
-           msg + ' '.join([repr(actual), expected[0], repr(expected[1:])]))
+@lru_cache(maxsize=1024)
+def _norm_expected(s):
+    # Expected values are YAML literals that repeat across tests. Normalize them once
+    return norm(s)
+
+
+def norm_str(s):
+    return norm(s) if isinstance(s, string_types) else s
+
+
+def match_operator(actual, expected, msg, prepared=None):
+    # prepared caches {prepare: prepare(actual)} across operators that match the same actual
+    op = expected[0]
+    spec = operators_cs.get(op)
+    if spec is None and isinstance(op, string_types):
+        spec = operators_ci.get(op.lower())
+    if spec is not None:
+        grouping, method, prepare = spec
+        value = actual
+        if prepare is not None:
+            if prepared is None:
+                value = prepare(actual)
+            elif prepare in prepared:
+                value = prepared[prepare]
+            else:
+                value = prepared[prepare] = prepare(actual)
+        if not grouping(method(value, item) for item in expected[1:]):
+            raise ConfError(msg + ' '.join([repr(actual), expected[0], repr(expected[1:])]))
     else:
         raise ConfError(msg + ' unknown operator: %s' % expected)
 
 
 def match(actual, expected, *msg):
     msg = 'FAIL: ' + '.'.join(msg) + ': '
-    err = lambda s: msg + s.format(a=actual, e=expected)   # noqa
     if not isinstance(actual, scalar):
-        eq(actual == expected, err('{a!r} == {e!r}'))
-    elif expected is None:
-        eq(actual is None, err('{a!r} is None'))
-    elif expected is True:
-        eq(actual, err('{a!r} is truthy'))
-    elif expected is False:
-        eq(not actual, err('{a!r} is falsey'))
-    elif isinstance(expected, scalar):
-        eq(actual == expected, err('{a!r} == {e!r}'))
-    elif isinstance(expected, list):
-        if len(expected):
-            if isinstance(expected[0], scalar):
-                match_operator(actual, expected, msg)
-            elif isinstance(expected[0], list):
-                for item in expected:
-                    match_operator(actual, item, msg)
-            else:
-                raise ConfError(err('cannot compare {a!r} with {e!r}'))
-        else:
-            raise ConfError(err('cannot compare {a!r} with {e!r}'))
+        if not actual == expected:
+            raise ConfError(fail(msg, '{a!r} == {e!r}', actual, expected))
     else:
-        raise ConfError(err('cannot compare {a!r} with {e!r}'))
+        match_methods.get(type(expected), match_other)(actual, expected, msg)
+
+
+def fail(msg, template, actual, expected):
+    # Format the failure message only on failure. repr(actual) may be a large response
+    return msg + template.format(a=actual, e=expected)
+
+
+def match_none(actual, expected, msg):
+    if actual is not None:
+        raise ConfError(fail(msg, '{a!r} is None', actual, expected))
+
+
+def match_bool(actual, expected, msg):
+    if expected and not actual:
+        raise ConfError(fail(msg, '{a!r} is truthy', actual, expected))
+    elif not expected and actual:
+        raise ConfError(fail(msg, '{a!r} is falsey', actual, expected))
+
+
+def match_scalar(actual, expected, msg):
+    if not actual == expected:
+        raise ConfError(fail(msg, '{a!r} == {e!r}', actual, expected))
+
+
+def match_list(actual, expected, msg):
+    if len(expected):
+        if isinstance(expected[0], scalar):
+            return match_operator(actual, expected, msg)
+        elif isinstance(expected[0], list):
+            prepared = {}
+            for item in expected:
+                match_operator(actual, item, msg, prepared)
+            return
+    raise ConfError(fail(msg, 'cannot compare {a!r} with {e!r}', actual, expected))
+
+
+def match_other(actual, expected, msg):
+    # Subclasses of the types in match_methods are matched like their parent type
+    for types, method in ((bool, match_bool), (scalar, match_scalar), (list, match_list)):
+        if isinstance(expected, types):
+            return method(actual, expected, msg)
+    raise ConfError(fail(msg, 'cannot compare {a!r} with {e!r}', actual, expected))
+
+
+@lru_cache(maxsize=512)
+def _regex(pattern, flags=0):
+    return re.compile(pattern, flags)
 
 
+# Case-insensitive operators receive the actual value a normalized by prepare=
 def case_insensitive_eq(a, e):
     s = isinstance(a, string_types) and isinstance(e, string_types)
-    return norm(e) == norm(a) if s else e == a
+    return _norm_expected(e) == a if s else e == a
 
 
 def case_insensitive_ne(a, e):
     s = isinstance(a, string_types) and isinstance(e, string_types)
-    return norm(e) != norm(a) if s else e != a
+    return _norm_expected(e) != a if s else e != a
 
 
 scalar = (int, float) + string_types
-operators = {}
-add_operator(any, 'equal', 'equals', 'is', case_insensitive_eq)
+# operators_cs has case-sensitive UPPERCASE operators. operators_ci has lowercase keys
+operators_cs, operators_ci = {}, {}
+# match() picks a method based on the type of the expected value
+match_methods = {type(None): match_none, bool: match_bool, list: match_list}
+match_methods.update({cls: match_scalar for cls in scalar})
+add_operator(any, 'equal', 'equals', 'is', case_insensitive_eq, prepare=norm_str)
 add_operator(any, 'EQUAL', 'EQUALS', 'IS', lambda a, e: e == a)
-add_operator(any, 'has', 'in', 'is in', lambda a, e: norm(e) in norm(a))
+add_operator(any, 'has', 'in', 'is in', lambda a, e: _norm_expected(e) in a, prepare=norm)
 add_operator(any, 'HAS', 'IN', 'IS IN', lambda a, e: e in a)
 add_operator(any, 'regex', 'match', 'matches',
-             lambda a, e: re.search(e, a, re.IGNORECASE))
-add_operator(any, 'REGEX', 'MATCH', 'MATCHES', lambda a, e: re.search(e, a))
+             lambda a, e: _regex(e, re.IGNORECASE).search(a))
+add_operator(any, 'REGEX', 'MATCH', 'MATCHES', lambda a, e: _regex(e).search(a))
 add_operator(any, 'starts with', 'startswith',
-             lambda a, e: norm(a).startswith(norm(e)))
+             lambda a, e: a.startswith(_norm_expected(e)), prepare=norm)
 add_operator(any, 'STARTS WITH', 'STARTSWITH', lambda a, e: a.startswith(e))
 add_operator(any, 'ends with', 'endswith',
-             lambda a, e: norm(a).endswith(norm(e)))
+             lambda a, e: a.endswith(_norm_expected(e)), prepare=norm)
 add_operator(any, 'ENDS WITH', 'ENDSWITH', lambda a, e: a.endswith(e))
-add_operator(all, 'does not equal', 'is not', 'not', 'no', case_insensitive_ne)
+add_operator(all, 'does not equal', 'is not', 'not', 'no', case_insensitive_ne,
+             prepare=norm_str)
 add_operator(all, 'DOES NOT EQUAL', 'IS NOT', 'NOT', 'NO', lambda a, e: e != a)
 add_operator(all, '>', 'greater than', lambda a, e: a > e)
 add_operator(all, '<', 'less than', lambda a, e: a < e)
 add_operator(all, '>=', 'greater than or equal to', lambda a, e: a >= e)
 add_operator(all, '<=', 'less than or equal to', lambda a, e: a <= e)
 add_operator(all, 'has no', 'has not', 'does not have', 'not in', 'is not in',
-             lambda a, e: norm(e) not in norm(a))
+             lambda a, e: _norm_expected(e) not in a, prepare=norm)
 add_operator(all, 'HAS NO', 'HAS NOT', 'DOES NOT HAVE', 'NOT IN', 'IS NOT IN',
              lambda a, e: e not in a)
 add_operator(all, 'does not match',
-             lambda a, e: not re.search(e, a, re.IGNORECASE))
-add_operator(all, 'DOES NOT MATCH', lambda a, e: not re.search(e, a))
+             lambda a, e: not _regex(e, re.IGNORECASE).search(a))
+add_operator(all, 'DOES NOT MATCH', lambda a, e: not _regex(e).search(a))
@@ -6,6 +6,23 @@ from gramex.transforms import build_transform
 from gramex.config import app_log, CustomJSONEncoder
 from .basehandler import BaseHandler
 from tornado.util import unicode_type
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_json_default = CustomJSONEncoder().default
+
+
+def _json_dumps(obj):
+    # orjson is faster. Pass datetimes & numpy types to CustomJSONEncoder like json.dumps does
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_json_default,
+                                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=True, cls=CustomJSONEncoder)
 
 
 class FunctionHandler(BaseHandler):
@@ -19,7 +36,8 @@ class FunctionHandler(BaseHandler):
         override ``args`` and ``kwargs`` below to replace it with other
         parameters. The result is rendered as-is (and hence must be a string, or
         a Future that resolves to a string.) You can also yield one or more
-        results. These are written immediately, in order.
+        results. These are written in order. The first result is sent immediately.
+        The rest are sent every 8KB, or when waiting for a Future.
     :arg list args: positional arguments to be passed to the function.
     :arg dict kwargs: keyword arguments to be passed to the function.
     :arg dict headers: HTTP headers to set on the response.
@@ -27,46 +45,95 @@ class FunctionHandler(BaseHandler):
         `['GET', 'POST']`.
     :arg string redirect: URL to redirect to when the result is done. Used to
         trigger calculations without displaying any output.
+    :arg bool streaming: ``true`` flushes each result as soon as it is available.
+        ``false`` writes all results in one response, retaining the Etag. By
+        default, results are flushed only if the function yields multiple results.
     '''
+    # Multipart responses flush after every flush_size bytes of results
+    flush_size = 8192
+
     @classmethod
-    def setup(cls, headers={}, methods=['GET', 'POST'], **kwargs):
+    def setup(cls, headers={}, methods=['GET', 'POST'], streaming=None, **kwargs):
         super(FunctionHandler, cls).setup(**kwargs)
-        # Don't use cls.info.function = build_transform(...) -- Python treats it as a method
-        cls.info = {}
-        cls.info['function'] = build_transform(kwargs, vars={'handler': None},
-                                               filename='url: %s' % cls.name)
+        # staticmethod() prevents Python from treating the function as a method
+        cls.function = staticmethod(build_transform(kwargs, vars={'handler': None},
+                                                    filename='url: %s' % cls.name))
         cls.headers = headers
+        # Pick the GET/POST implementation once here, rather than checking results per request
+        get = {True: cls._get_stream, False: cls._get_single}.get(streaming, cls._get)
         for method in (methods if isinstance(methods, (tuple, list)) else [methods]):
-            setattr(cls, method.lower(), cls._get)
+            setattr(cls, method.lower(), get)
 
-    @tornado.gen.coroutine
-    def _get(self, *path_args):
+    def _run(self):
         if self.redirects:
             self.save_redirect_page()
 
-        if 'function' not in self.info:
-            raise ValueError('Invalid function definition in url:%s' % self.name)
-        result = self.info['function'](handler=self)
+        result = self.function(handler=self)
         for header_name, header_value in self.headers.items():
             self.set_header(header_name, header_value)
+        return result
+
+    def _write_item(self, item):
+        '''Write a string or dict result. Return the length written'''
+        if isinstance(item, (bytes, unicode_type, dict)):
+            item = _json_dumps(item) if isinstance(item, dict) else item
+            self.write(item)
+            return len(item)
+        app_log.warning('url:%s: FunctionHandler can write strings/dict, not %s',
+                        self.name, repr(item))
+        return 0
+
+    @tornado.gen.coroutine
+    def _get(self, *path_args):
+        result = self._run()
 
         # Use multipart to check if the respose has multiple parts. Don't
         # flush unless it's multipart. Flushing disables Etag
         multipart = isinstance(result, GeneratorType) or len(result) > 1
 
+        # Flush multipart responses after the first result, before waiting for a future, and
+        # when flush_size bytes are pending. Flushing every small result slows the response.
+        # pending is None until the first result is written. Don't flush (i.e. send headers)
+        # before that, since the function may still set the status or headers, or fail
+        pending = None
         # build_transform results are iterable. Loop through each item
         for item in result:
-            # Resolve futures and write the result immediately
+            # Resolve futures. Send what's pending before waiting
             if tornado.concurrent.is_future(item):
+                if multipart and pending:
+                    self.flush()
+                    pending = 0
                 item = yield item
-            if isinstance(item, (bytes, unicode_type, dict)):
-                self.write(json.dumps(item, separators=(',', ':'), ensure_ascii=True,
-                                      cls=CustomJSONEncoder) if isinstance(item, dict) else item)
-                if multipart:
+            size = self._write_item(item)
+            if multipart and size:
+                if pending is None or pending + size >= self.flush_size:
                     self.flush()
-            else:
-                app_log.warning('url:%s: FunctionHandler can write strings/dict, not %s',
-                                self.name, repr(item))
+                    pending = 0
+                else:
+                    pending += size
+
+        if self.redirects:
+            self.redirect_next()
+
+    @tornado.gen.coroutine
+    def _get_single(self, *path_args):
+        # streaming: false. Write all results without flushing
+        for item in self._run():
+            if tornado.concurrent.is_future(item):
+                item = yield item
+            self._write_item(item)
+
+        if self.redirects:
+            self.redirect_next()
+
+    @tornado.gen.coroutine
+    def _get_stream(self, *path_args):
+        # streaming: true. Flush each result as soon as it is available
+        for item in self._run():
+            if tornado.concurrent.is_future(item):
+                item = yield item
+            if self._write_item(item):
+                self.flush()
 
         if self.redirects:
             self.redirect_next()
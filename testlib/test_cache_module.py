@@ -5,17 +5,22 @@ import six
 import json
 import time
 import yaml
+import shutil
 import unittest
+import cachetools
 import gramex.cache
 import pandas as pd
 import sqlalchemy as sa
 from lxml import etree
 from gramex.cache import hashfn
 from gramex.config import variables, str_utf8
+from gramex.transforms import build_transform
 from six import string_types
 from markdown import markdown
 from collections import OrderedDict
 from orderedattrdict import AttrDict
+from tornado import gen
+from tornado.ioloop import IOLoop
 from tornado.template import Template
 from orderedattrdict.yamlutils import AttrDictYAMLLoader
 from pandas.util.testing import assert_frame_equal
@@ -127,6 +132,18 @@ class TestOpener(unittest.TestCase):
         result = o(path, num=1, s='a', none=None)
         eq_(result.kwargs, {'num': 1, 's': 'a', 'none': None})
 
+    def test_reader_newline(self):
+        o = gramex.cache.opener(self.check_args, read=True)
+        path = os.path.join(cache_folder, '.newline.txt')
+        try:
+            with io.open(path, 'wb') as handle:
+                handle.write('a\r\nb\rc\n高'.encode('utf-8'))
+            for newline in (None, '', '\n', '\r\n'):
+                with io.open(path, encoding='utf-8', newline=newline) as handle:
+                    eq_(o(path, newline=newline).args, (handle.read(), ))
+        finally:
+            os.remove(path)
+
 
 class TestOpen(unittest.TestCase):
     @staticmethod
@@ -145,6 +162,12 @@ class TestOpen(unittest.TestCase):
         result = gramex.cache.open(path, 'txt', rel=True)
         eq_(result, expected)
 
+    def test_relative_to(self):
+        # relative_to(file) opens paths relative to the file's folder
+        _open = gramex.cache.relative_to(__file__)
+        path = os.path.join(cache_folder, 'template.txt')
+        eq_(_open('test_cache/template.txt', 'txt'), gramex.cache.open(path, 'txt'))
+
     def test_open_text(self):
         path = os.path.join(cache_folder, 'template.txt')
         expected = io.open(path, encoding='utf-8', errors='ignore').read()
@@ -181,6 +204,28 @@ class TestOpen(unittest.TestCase):
 
         self.check_file_cache(path, check)
         assert_frame_equal(gramex.cache.open(path), gramex.cache.open(path, 'csv'))
+        # Unknown engines fall back to the default engine
+        assert_frame_equal(gramex.cache.open(path, 'csv', engine='nonexistent'), expected)
+        # Parse errors are raised as-is. Only unknown engines are retried with the default engine
+        bad = os.path.join(cache_folder, 'bad-engine.csv')
+        with io.open(bad, 'w', encoding='utf-8') as handle:
+            handle.write('a,b\n1,2\n3,4,5\n')
+        engines = []
+
+        def read_csv(path, **kwargs):
+            engines.append(kwargs.get('engine'))
+            return pd.read_csv(path, **kwargs)
+
+        reader = gramex.cache._engine_fallback(read_csv)
+        try:
+            for engine, tried in (('c', ['c']), ('python', ['python']),
+                                  ('nonexistent', ['nonexistent', None])):
+                del engines[:]
+                with assert_raises(pd.errors.ParserError):
+                    reader(bad, engine=engine)
+                eq_(engines, tried)
+        finally:
+            os.remove(bad)
 
     def test_open_json(self):
         path = os.path.join(cache_folder, 'data.json')
@@ -196,6 +241,7 @@ class TestOpen(unittest.TestCase):
 
         self.check_file_cache(path, check)
         eq_(gramex.cache.open(path), gramex.cache.open(path, 'json'))
+        eq_(gramex.cache.open(path, 'json'), expected)
 
     def test_open_jsondata(self):
         path = os.path.join(cache_folder, 'data.jsondata')
@@ -223,6 +269,7 @@ class TestOpen(unittest.TestCase):
 
         self.check_file_cache(path, check)
         eq_(gramex.cache.open(path), gramex.cache.open(path, 'yaml'))
+        eq_(gramex.cache.open(path, 'yaml'), expected)
 
     def test_open_template(self):
         path = os.path.join(cache_folder, 'template.txt')
@@ -374,6 +421,25 @@ class TestOpen(unittest.TestCase):
         self.assertIn(cache_key, new_cache)
         self.assertNotIn(cache_key, old_cache)
 
+    def test_lru_cache(self):
+        # The default caches evict least recently used results to stay within GRAMEX_CACHE_BYTES
+        cache = gramex.cache._bounded_cache()
+        ok_(isinstance(cache, cachetools.LRUCache))
+        eq_(cache.maxsize, gramex.cache._CACHE_BYTES)
+        path = os.path.join(cache_folder, 'data.csv')
+        data = gramex.cache.open(path, 'csv')
+        size = gramex.cache.sizeof((data, gramex.cache.stat(path)))
+        cache = cachetools.LRUCache(maxsize=size * 2.5, getsizeof=gramex.cache.sizeof)
+        kwargs = {'_cache': cache, '_reload_status': True}
+        eq_(gramex.cache.open(path, 'csv', **kwargs)[1], True)
+        eq_(gramex.cache.open(path, 'csv', **kwargs)[1], False)
+        # Results too large to cache are returned, but not cached
+        cache = cachetools.LRUCache(maxsize=size / 2, getsizeof=gramex.cache.sizeof)
+        kwargs = {'_cache': cache, '_reload_status': True}
+        eq_(gramex.cache.open(path, 'csv', **kwargs)[1], True)
+        eq_(gramex.cache.open(path, 'csv', **kwargs)[1], True)
+        eq_(len(cache), 0)
+
     def test_multiple_loaders(self):
         # Loading the same file via different callbacks should return different results
         path = os.path.join(cache_folder, 'multiformat.csv')
@@ -398,6 +464,55 @@ class TestOpen(unittest.TestCase):
         stat = os.stat(path)
         eq_(gramex.cache.stat(path), (stat.st_mtime, stat.st_size))
         eq_(gramex.cache.stat('nonexistent'), (None, None))
+        fstat = gramex.cache.stat(path, hash=True)
+        eq_(fstat[:2], (stat.st_mtime, stat.st_size))
+        ok_(isinstance(fstat[2], string_types))
+        eq_(gramex.cache.stat('nonexistent', hash=True), (None, None, None))
+
+    def test_stat_ttl(self):
+        # stat(ttl=) does not re-check the file within ttl seconds
+        path = os.path.join(cache_folder, 'data.yaml')
+        fstat = gramex.cache.stat(path, ttl=60)
+        time.sleep(small_delay)
+        touch(path)
+        eq_(gramex.cache.stat(path, ttl=60), fstat)
+        ok_(gramex.cache.stat(path) != fstat)
+
+    def test_watch_stat(self):
+        # watch_stat() remembers stats until watchdog reports a change
+        path = os.path.join(cache_folder, 'data.yaml')
+        ok_(gramex.cache.watch_stat())
+        try:
+            fstat = gramex.cache.stat(path)
+            self.assertIn(path, gramex.cache._WATCHED_STATS)
+            # Only the file's folder is watched, not its sub-folders
+            watch = gramex.cache._WATCHED_FOLDERS[os.path.dirname(os.path.abspath(path))]
+            eq_(watch.is_recursive, False)
+            eq_(gramex.cache.stat(path), fstat)
+            time.sleep(small_delay)
+            touch(path)
+            for attempt in range(100):
+                if path not in gramex.cache._WATCHED_STATS:
+                    break
+                time.sleep(small_delay)
+            ok_(gramex.cache.stat(path) != fstat)
+        finally:
+            eq_(gramex.cache.watch_stat(False), False)
+        eq_(gramex.cache._WATCHED_STATS, {})
+        # Disabling watch_stat removes the watches
+        eq_(gramex.cache._WATCHED_FOLDERS, {})
+        from gramex.services.watcher import observer
+        ok_(all(emitter.watch != watch for emitter in observer.emitters))
+
+    def test_open_hash(self):
+        # hash=True reloads only if the contents change, not the mtime
+        path = os.path.join(cache_folder, 'data.yaml')
+        kwargs = {'_reload_status': True, '_cache': {}, 'hash': True}
+        eq_(gramex.cache.open(path, 'yaml', **kwargs)[1], True)
+        eq_(gramex.cache.open(path, 'yaml', **kwargs)[1], False)
+        time.sleep(small_delay)
+        touch(path)
+        eq_(gramex.cache.open(path, 'yaml', **kwargs)[1], False)
 
     def test_transform(self):
         # Check that transform function is applied and used as a cache key
@@ -423,6 +538,17 @@ class TestOpen(unittest.TestCase):
         cache_key = (path, 'csv', hashfn('ignore'), frozenset([]))
         self.assertIn(cache_key, cache)
 
+        # jit=True gives the same result, whether or not the transform can be compiled
+        data = gramex.cache.open(path, 'csv', transform=len, jit=True, _cache={})
+        eq_(data, len(pd.read_csv(path)))                   # noqa - ignore encoding
+
+        def transform3(d):
+            return d.sum()
+
+        data = gramex.cache.open(path, lambda path: pd.read_csv(path)['a'].values,   # noqa
+                                 transform=transform3, jit=True, _cache=cache)
+        eq_(data, pd.read_csv(path)['a'].sum())             # noqa - ignore encoding
+
         # Check that temporary caches are hashed by function
         v = 1
         data = gramex.cache.open(path, 'csv', lambda x: v, _cache=cache)
@@ -431,6 +557,38 @@ class TestOpen(unittest.TestCase):
         data = gramex.cache.open(path, 'csv', lambda x: v, _cache=cache)
         eq_(data, 2)
 
+    def test_shared_cache(self):
+        # Caches shared across processes (e.g. disk) don't use process-specific id() as keys
+        from diskcache import Cache as DiskCache
+        path = os.path.join(cache_folder, 'data.csv')
+        cache = DiskCache(os.path.join(cache_folder, '.shared-cache'))
+        try:
+            kwargs = {'_cache': cache, '_reload_status': True}
+            data, reloaded = gramex.cache.open(path, pd.read_csv, **kwargs)
+            assert_frame_equal(data, pd.read_csv(path))     # noqa - ignore encoding
+            eq_(reloaded, True)
+            key = next(iter(cache))
+            eq_(key[1][:2], (pd.read_csv.__module__, 'read_csv'))
+            eq_(key[2], None)
+            data, reloaded = gramex.cache.open(path, pd.read_csv, **kwargs)
+            eq_(reloaded, False)
+            # Lambdas can't be shared across processes. Their key has the process ID
+            gramex.cache.open(path, 'csv', transform=lambda x: x, _cache=cache)
+            ok_(any(key[2] and key[2][0] == os.getpid() for key in cache))
+            # YAML transforms have the same name. Those that differ only in a constant differ
+            vars = {'data': None}
+            expected = pd.read_csv(path)
+            for col in ('a', 'b'):
+                fn = build_transform({'function': 'data[%r].tolist()' % col}, vars, iter=False)
+                eq_(gramex.cache.open(path, 'csv', transform=fn, _cache=cache),
+                    expected[col].tolist())
+            # kwargs are keyed as a sorted tuple, since frozenset order varies across processes
+            gramex.cache.open(path, 'csv', encoding='utf-8', sep=',', _cache=cache)
+            ok_((('encoding', 'utf-8'), ('sep', ',')) in [key[3] for key in cache])
+        finally:
+            cache.close()
+            shutil.rmtree(cache.directory, ignore_errors=True)
+
 
 class TestSqliteCacheQuery(unittest.TestCase):
     data = pd.read_csv(os.path.join(cache_folder, 'data.csv'), encoding='utf-8')
@@ -447,11 +605,17 @@ class TestSqliteCacheQuery(unittest.TestCase):
 
     def test_wheres(self):
         w = gramex.cache._wheres
-        eq_(w('db', 'tbl', 'db', ['x']), "(db='db' AND tbl='x')")
-        eq_(w('db', 'tbl', 'db', ['x', 'y']), "(db='db' AND tbl='x') OR (db='db' AND tbl='y')")
-        eq_(w('db', 'tbl', 'db', ['a.x']), "(db='a' AND tbl='x')")
-        eq_(w('db', 'tbl', 'db', ['a.x', 'y']), "(db='a' AND tbl='x') OR (db='db' AND tbl='y')")
-        eq_(w('db', 'tbl', 'db', ['a.x', 'b.y']), "(db='a' AND tbl='x') OR (db='b' AND tbl='y')")
+        eq_(w('db', 'tbl', 'db', ['x']), ('(db=:db0 AND tbl=:table0)', {
+            'db0': 'db', 'table0': 'x'}))
+        eq_(w('db', 'tbl', 'db', ['x', 'y']), (
+            '(db=:db0 AND tbl=:table0) OR (db=:db1 AND tbl=:table1)',
+            {'db0': 'db', 'table0': 'x', 'db1': 'db', 'table1': 'y'}))
+        eq_(w('db', 'tbl', 'db', ['a.x', 'b.y'])[1], {
+            'db0': 'a', 'table0': 'x', 'db1': 'b', 'table1': 'y'})
+        eq_(w('db', 'tbl', 'db', ['a.x'], fn=['F', 'G']), ('(db=F(:db0) AND tbl=G(:table0))', {
+            'db0': 'a', 'table0': 'x'}))
+        # Table names are not interpolated into the SQL
+        eq_(w('db', 'tbl', 'db', ["x' OR 1=1 --"])[1]['table0'], "x' OR 1=1 --")
 
     def test_query_state_invalid(self):
         # Empty state list raises an error
@@ -507,6 +671,18 @@ class TestSqliteCacheQuery(unittest.TestCase):
         eq_(gramex.cache.query(**kwargs)[1], True, msg)
         eq_(gramex.cache.query(**kwargs)[1], True, msg)
 
+    def test_query_state_digest(self):
+        # String states store a hash of the state query's result, not the result itself
+        cache = {}
+        gramex.cache.query('SELECT * FROM t1', self.engine, state='SELECT * FROM t2', _cache=cache)
+        status = next(iter(cache.values()))['status']
+        ok_(isinstance(status, string_types))
+        # Unhashable values (e.g. from ARRAY or JSON columns) are digested too
+        digest = gramex.cache._frame_digest
+        eq_(digest(pd.DataFrame({'a': [[1], {'x': 2}]})),
+            digest(pd.DataFrame({'a': [[1], {'x': 2}]})))
+        ok_(digest(pd.DataFrame({'a': [[1], [2]]})) != digest(pd.DataFrame({'a': [[1], [3]]})))
+
 
 class TestMySQLCacheQuery(TestSqliteCacheQuery):
     states = ['SELECT COUNT(*) FROM t1', lambda: gramex.cache.stat(state_file)]
@@ -623,6 +799,36 @@ class TestSubprocess(unittest.TestCase):
             items.add(proc.queue_out.get_nowait())
         eq_(items, {self.msg(s) for s in ('OUT:0', 'OUT:1', 'ERR:0', 'ERR:1')})
 
+    def test_ioloop(self):
+        # Inside a running IOLoop, streams are read by the IOLoop, not threads
+        @gen.coroutine
+        def run():
+            proc = gramex.cache.Subprocess(self.args1)
+            eq_(proc.thread, {})
+            stdout, stderr = yield proc.wait_for_exit()
+            eq_(stdout, self.msg('OUT:0') + self.msg('OUT:1'))
+            eq_(stderr, self.msg('ERR:0') + self.msg('ERR:1'))
+            eq_(proc.proc.returncode, 0)
+
+            proc = gramex.cache.Subprocess(
+                self.args1, stream_stdout='list_out', stream_stderr='list_err', buffer_size='line')
+            yield proc.wait_for_exit()
+            eq_(proc.list_out, [self.msg('OUT:0'), self.msg('OUT:1')])
+            eq_(proc.list_err, [self.msg('ERR:0'), self.msg('ERR:1')])
+
+            # buffer_size=<n> sends chunks of n bytes, and the rest at the end
+            proc = gramex.cache.Subprocess(self.args1, stream_stdout='list_out', buffer_size=4)
+            yield proc.wait_for_exit()
+            out = self.msg('OUT:0') + self.msg('OUT:1')
+            eq_(proc.list_out, [out[i:i + 4] for i in range(0, len(out), 4)])
+
+        # Close the IOLoop so that later tests don't treat it as the current loop
+        loop = IOLoop()
+        try:
+            loop.run_sync(run)
+        finally:
+            loop.close()
+
     def test_daemon_reuse(self):
         procs = [
             wait(gramex.cache.daemon(self.args)),
@@ -658,6 +864,45 @@ class TestSubprocess(unittest.TestCase):
         proc = wait(gramex.cache.daemon(self.args, first_line=re.compile(r'(OUT|ERR):\d\s*')))
         [wait(future) for future in proc.wait_for_exit()]
 
+    def test_daemon_ioloop(self):
+        # A daemon that prints many lines after its first_line must not block a running IOLoop
+        chatty = ['python', '-c', 'for i in range(30): print("line %d" % i)']
+
+        @gen.coroutine
+        def run():
+            out = []
+            proc = yield gramex.cache.daemon(chatty, first_line='line 0', stream=out.append)
+            yield proc.wait_for_exit()
+            eq_(out, [self.msg('line %d' % i) for i in range(30)])
+
+        loop = IOLoop()
+        try:
+            loop.run_sync(run, timeout=10)
+        finally:
+            loop.close()
+
+    def test_callback_error(self):
+        # A callback that raises is dropped. Other callbacks get the output and the process ends
+        def fail(content):
+            raise ValueError('write to closed file')
+
+        @gen.coroutine
+        def run():
+            proc = gramex.cache.Subprocess(self.hello, stream_stdout=[fail, 'list_out'])
+            yield proc.wait_for_exit()
+            return proc
+
+        # ... both when reading from a running IOLoop, and from threads
+        loop = IOLoop()
+        try:
+            proc = loop.run_sync(run, timeout=10)
+        finally:
+            loop.close()
+        eq_(proc.list_out, [self.msg('hello')])
+        proc = gramex.cache.Subprocess(self.hello, stream_stdout=[fail, 'list_out'])
+        [wait(future) for future in proc.wait_for_exit()]
+        eq_(proc.list_out, [self.msg('hello')])
+
 
 def tearDownModule():
     if os.path.exists(state_file):
@@ -0,0 +1,43 @@
+import unittest
+from orderedattrdict import AttrDict
+from gramex import gramextest
+from nose.tools import eq_, ok_
+
+
+class Session(object):
+    '''A pytest session stub with the items that pytest will run'''
+    def __init__(self, items):
+        self.items = items
+
+
+class TestParallelFetch(unittest.TestCase):
+    def tearDown(self):
+        gramextest.URLTest.r = None
+        if gramextest.URLTest.session is not None:
+            gramextest.URLTest.session.close()
+            gramextest.URLTest.session = None
+
+    def test_selected_items(self):
+        # parallel: true fetches only items that will run, and only until the first skip:
+        batch = gramextest.ParallelFetch(2)
+        registries, items = {}, {}
+        for url in ('a', 'b', 'c', 'd'):
+            registry = registries[url] = gramextest.URLTest()
+            # Return the URL instead of fetching it
+            registry._request = lambda url, **kwargs: url
+            steps = [[registry.fetch, [url], {}]]
+            if url == 'c':
+                steps.append([registry.skip, [True], {}])
+            items[url] = AttrDict(run=steps, parallel=(batch, registry))
+        # 'b' is deselected (e.g. via -k). Items without a batch (e.g. uitest:) are ignored
+        session = Session([items['a'], items['c'], AttrDict(run=[]), items['d']])
+        gramextest.pytest_collection_finish(session)
+        eq_([args for method, args, kwargs in batch.calls], [['a'], ['c']])
+        ok_(items['b'].run[0][0] == registries['b'].fetch)
+        ok_(items['d'].run[0][0] == registries['d'].fetch)
+
+        # Batched items get their own response
+        for url in ('c', 'a'):
+            method, args, kwargs = items[url].run[0]
+            method(*args, **kwargs)
+            eq_(gramextest.URLTest.r, url)
@@ -1,5 +1,6 @@
 from . import TestGramex
 from gramex.http import FOUND
+from nose.tools import eq_
 
 
 class TestFunctionHandler(TestGramex):
@@ -38,12 +39,32 @@ class TestFunctionHandler(TestGramex):
 
     def test_json(self):
         self.check('/func/numpytypes')
+        # Dicts with datetimes, numpy values and non-str keys are serialized like json.dumps
+        r = self.check('/func/jsontypes')
+        eq_(r.text, '{"date":"2020-01-02T03:04:05+00:00","int":1,"float":1.5,"array":[0,1,2],'
+                    '"bool":true,"1":"int key","2.5":"float key","null":"null key"}')
 
     def test_iterator(self):
         no_etag = {'headers': {'Etag': False}}
         self.check('/func/iterator?x=1&x=2&x=3', text='123', **no_etag)
         self.check('/func/iterator/async?x=1&x=2&x=3', text='123', **no_etag)
 
+    def test_streaming(self):
+        # streaming: false writes all results at once, streaming: true flushes each result
+        self.check('/func/iterator/single?x=1&x=2&x=3', text='123', headers={'Etag': True})
+        self.check('/func/args/stream', text='{"args": [], "kwargs": {}}',
+                   headers={'Etag': False})
+
+    def test_flush(self):
+        # Small results are flushed in chunks. The full body is still sent
+        r = self.check('/func/iterator/large', headers={'Etag': False})
+        eq_(r.text, ''.join('%05d,' % index for index in range(2000)))
+        # Headers aren't sent before the first result. So a Future as the first result can
+        # set the status, or fail with an error
+        self.check('/func/iterator/future-first', code=201, text='status:done')
+        self.check('/func/iterator/future-first?status=202', code=202, text='status:done')
+        self.check('/func/iterator/future-first?error=fail', code=500)
+
     def test_redirect(self):
         r = self.get('/func/redirect', allow_redirects=False)
         self.assertEqual(r.headers.get('Location'), '/dir/index/')
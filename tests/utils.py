@@ -5,6 +5,7 @@ import six
 import sys
 import json
 import time
+import datetime
 import random
 import pandas as pd
 from collections import Counter
@@ -437,3 +438,39 @@ if __name__ == '__main__':
     method_name = sys.argv[1]
     method = globals().get(method_name)
     method()
+
+
+def iterator_large(handler):
+    '''Yield over 8KB of small strings'''
+    for index in range(2000):
+        yield '%05d,' % index
+
+
+@gen.coroutine
+def future_status(handler):
+    '''Set the HTTP status to ?status=. If ?error= is set, raise an error instead'''
+    yield gen.moment
+    if handler.get_argument('error', None):
+        raise ValueError(handler.get_argument('error'))
+    handler.set_status(int(handler.get_argument('status', '201')))
+    raise gen.Return('status')
+
+
+def iterator_future_first(handler):
+    '''Yield a Future that sets the status (or fails) as the first result'''
+    yield future_status(handler)
+    yield ':done'
+
+
+def json_types(handler):
+    '''Return a dict with a datetime, numpy values and non-str keys'''
+    return {
+        'date': datetime.datetime(2020, 1, 2, 3, 4, 5),
+        'int': pd.np.int64(1),
+        'float': pd.np.float64(1.5),
+        'array': pd.np.arange(3),
+        'bool': pd.np.bool_(True),
+        1: 'int key',
+        2.5: 'float key',
+        None: 'null key',
+    }